@@ -3,13 +3,15 @@ This script demonstrates using the RBF-FD method to calculate
 two-dimensional topographic stresses with roller boundary conditions.
 '''
 import numpy as np
-from scipy.sparse.linalg import spsolve, gmres
+from scipy.sparse.linalg import spsolve, spilu, gmres, LinearOperator
 import matplotlib.pyplot as plt
 from matplotlib.patches import Polygon
-from scipy.interpolate import griddata
+from scipy.interpolate import LinearNDInterpolator
+from scipy.spatial import Delaunay
 import scipy.sparse as sp
 from rbf.nodes import min_energy_nodes
-from rbf.fd import weight_matrix, add_rows
+from rbf.fd import weight_matrices
+from rbf.stencil import stencil_network
 from rbf.fdbuild import (elastic2d_body_force,
                          elastic2d_surface_force,
                          elastic2d_displacement)
@@ -31,10 +33,38 @@ def find_orthogonals(n):
     corresponding vector in *n*.
     
   '''
-  out = np.empty_like(n, dtype=float)
-  out[:, 0] = -np.sum(n, axis=1) + n[:,0]
-  out[:, 1:] = n[:, [0]]
-  out /= np.linalg.norm(out, axis=1)[:,None]
+  # rotate each vector by 90 degrees and normalize it
+  nx, ny = n[:, 0], n[:, 1]
+  inv_norm = 1.0/np.sqrt(nx*nx + ny*ny)
+  out = np.column_stack((-ny*inv_norm, nx*inv_norm))
+  return out
+
+def stash_rows(stash, B, idx, scale=None):
+  ''' 
+  Appends the nonzero entries of the sparse matrix `B` to `stash`,
+  where the rows of `B` are mapped to the rows `idx` of the
+  left-hand-side matrix. If `scale` is given, then each row of `B` is
+  multiplied by the corresponding element of `scale`. The stashed
+  entries are assembled into a sparse matrix with `assemble`.
+  '''
+  B = sp.coo_matrix(B)
+  data = B.data
+  if scale is not None:
+    data = data*scale[B.row]
+
+  stash['rows'] += [idx[B.row]]
+  stash['cols'] += [B.col]
+  stash['data'] += [data]
+
+def assemble(stash, shape):
+  ''' 
+  Assembles the entries in `stash` into a sparse matrix. Duplicate
+  entries are summed.
+  '''
+  data = np.hstack(stash['data'])
+  rows = np.hstack(stash['rows'])
+  cols = np.hstack(stash['cols'])
+  out = sp.coo_matrix((data, (rows, cols)), shape=shape)
   return out
 
 ####################### USER PARAMETERS #############################
@@ -60,6 +90,10 @@ n = 20
 # Lame parameters
 lamb = 1.0
 mu = 1.0
+# this controls the sparsity of the ILU decompositions used for the
+# preconditioner. Smaller values make the decompositions denser but
+# better approximate the LU decomposition.
+ilu_drop_tol = 1e-4
 #####################################################################
 # generate nodes. Note that this may take a while
 groups = {'roller':[0, 1, 299],
@@ -72,86 +106,176 @@ nodes, idx, normals = min_energy_nodes(
 # update `N` to include ghosts
 N = nodes.shape[0]
 
-# allocate the left-hand-side matrix components
-G_xx = sp.csc_matrix((N,N))
-G_xy = sp.csc_matrix((N,N))
-G_yx = sp.csc_matrix((N,N))
-G_yy = sp.csc_matrix((N,N))
+# the nonzero entries of the left-hand-side matrix components are
+# collected and then assembled into sparse matrices at once
+G_xx = {'rows': [], 'cols': [], 'data': []}
+G_xy = {'rows': [], 'cols': [], 'data': []}
+G_yx = {'rows': [], 'cols': [], 'data': []}
+G_yy = {'rows': [], 'cols': [], 'data': []}
+
+# find the stencil for each node once. The constraints are imposed
+# at subsets of the nodes, so the stencils for each constraint are
+# rows of `stencils`. The first node in each stencil is the node
+# itself, which is the stencil used for the displacement constraints
+stencils = stencil_network(nodes, nodes, n)
+
+# build the weight matrices for each constraint. Each task consists
+# of a function from `rbf.fdbuild`, its positional arguments, and the
+# stencils. The tasks are not run in parallel because most of the time
+# is spent generating the RBF derivatives the first time they are
+# used, and worker processes would each have to repeat that
+def build_constraint(task):
+  func, args, stencils = task
+  return func(*args, lamb=lamb, mu=mu, stencils=stencils)
+
+tasks = [(elastic2d_body_force, (nodes[idx['interior']], nodes), stencils[idx['interior']]),
+         (elastic2d_body_force, (nodes[idx['boundary:free']], nodes), stencils[idx['boundary:free']]),
+         (elastic2d_body_force, (nodes[idx['boundary:roller']], nodes), stencils[idx['boundary:roller']]),
+         (elastic2d_surface_force, (nodes[idx['boundary:free']], normals[idx['boundary:free']], nodes), stencils[idx['boundary:free']]),
+         (elastic2d_displacement, (nodes[idx['boundary:roller']], nodes), stencils[idx['boundary:roller'], :1]),
+         (elastic2d_surface_force, (nodes[idx['boundary:roller']], normals[idx['boundary:roller']], nodes), stencils[idx['boundary:roller']])]
+outs = [build_constraint(task) for task in tasks]
 
 # build the "left hand side" matrices for body force constraints
-out = elastic2d_body_force(nodes[idx['interior']], nodes, lamb=lamb, mu=mu, n=n)
-G_xx = add_rows(G_xx, out['xx'], idx['interior'])
-G_xy = add_rows(G_xy, out['xy'], idx['interior'])
-G_yx = add_rows(G_yx, out['yx'], idx['interior'])
-G_yy = add_rows(G_yy, out['yy'], idx['interior'])
+out = outs[0]
+stash_rows(G_xx, out['xx'], idx['interior'])
+stash_rows(G_xy, out['xy'], idx['interior'])
+stash_rows(G_yx, out['yx'], idx['interior'])
+stash_rows(G_yy, out['yy'], idx['interior'])
 
 
-out = elastic2d_body_force(nodes[idx['boundary:free']], nodes, lamb=lamb, mu=mu, n=n)
-G_xx = add_rows(G_xx, out['xx'], idx['ghosts:free'])
-G_xy = add_rows(G_xy, out['xy'], idx['ghosts:free'])
-G_yx = add_rows(G_yx, out['yx'], idx['ghosts:free'])
-G_yy = add_rows(G_yy, out['yy'], idx['ghosts:free'])
+out = outs[1]
+stash_rows(G_xx, out['xx'], idx['ghosts:free'])
+stash_rows(G_xy, out['xy'], idx['ghosts:free'])
+stash_rows(G_yx, out['yx'], idx['ghosts:free'])
+stash_rows(G_yy, out['yy'], idx['ghosts:free'])
 
-out = elastic2d_body_force(nodes[idx['boundary:roller']], nodes, lamb=lamb, mu=mu, n=n)
-G_xx = add_rows(G_xx, out['xx'], idx['ghosts:roller'])
-G_xy = add_rows(G_xy, out['xy'], idx['ghosts:roller'])
-G_yx = add_rows(G_yx, out['yx'], idx['ghosts:roller'])
-G_yy = add_rows(G_yy, out['yy'], idx['ghosts:roller'])
+out = outs[2]
+stash_rows(G_xx, out['xx'], idx['ghosts:roller'])
+stash_rows(G_xy, out['xy'], idx['ghosts:roller'])
+stash_rows(G_yx, out['yx'], idx['ghosts:roller'])
+stash_rows(G_yy, out['yy'], idx['ghosts:roller'])
 
 
 # build the "left hand side" matrices for free surface constraints
-out = elastic2d_surface_force(nodes[idx['boundary:free']], normals[idx['boundary:free']], nodes, lamb=lamb, mu=mu, n=n)
-G_xx = add_rows(G_xx, out['xx'], idx['boundary:free'])
-G_xy = add_rows(G_xy, out['xy'], idx['boundary:free'])
-G_yx = add_rows(G_yx, out['yx'], idx['boundary:free'])
-G_yy = add_rows(G_yy, out['yy'], idx['boundary:free'])
-
-# build the "left hand side" matrices for roller constraints
-# constrain displacements in the surface normal direction
-out = elastic2d_displacement(nodes[idx['boundary:roller']], nodes, lamb=lamb, mu=mu, n=1)
-normals_x = sp.diags(normals[idx['boundary:roller']][:, 0])
-normals_y = sp.diags(normals[idx['boundary:roller']][:, 1])
-G_xx = add_rows(G_xx, normals_x.dot(out['xx']), idx['boundary:roller'])
-G_xy = add_rows(G_xy, normals_y.dot(out['yy']), idx['boundary:roller'])
-# have zero traction parallel to the boundary
-out = elastic2d_surface_force(nodes[idx['boundary:roller']], normals[idx['boundary:roller']], nodes, lamb=lamb, mu=mu, n=n)
-parallels = find_orthogonals(normals[idx['boundary:roller']])
-parallels_x = sp.diags(parallels[:, 0])
-parallels_y = sp.diags(parallels[:, 1])
-G_yx = add_rows(G_yx, parallels_x.dot(out['xx']) + parallels_y.dot(out['yx']), idx['boundary:roller'])
-G_yy = add_rows(G_yy, parallels_x.dot(out['xy']) + parallels_y.dot(out['yy']), idx['boundary:roller'])
-
-G_x = sp.hstack((G_xx, G_xy))
-G_y = sp.hstack((G_yx, G_yy))
-G = sp.vstack((G_x, G_y))
-G = G.tocsc()
-
-# form the right-hand-side vector
-d_x = np.zeros((N,))
-d_y = np.zeros((N,))
-
-d_x[idx['interior']] = 0.0
-d_x[idx['ghosts:free']] = 0.0
-d_x[idx['ghosts:roller']] = 0.0
-d_x[idx['boundary:free']] = 0.0
-d_x[idx['boundary:roller']] = 0.0
-
-d_y[idx['interior']] = 1.0
-d_y[idx['ghosts:free']] = 1.0
-d_y[idx['ghosts:roller']] = 1.0
-d_y[idx['boundary:free']] = 0.0
-d_y[idx['boundary:roller']] = 0.0
-
-d = np.hstack((d_x,d_y))
-
-# solve the system using an LU decomposition 
-u = spsolve(G,d,permc_spec='MMD_ATA')
-u = np.reshape(u,(2,-1))
+out = outs[3]
+stash_rows(G_xx, out['xx'], idx['boundary:free'])
+stash_rows(G_xy, out['xy'], idx['boundary:free'])
+stash_rows(G_yx, out['yx'], idx['boundary:free'])
+stash_rows(G_yy, out['yy'], idx['boundary:free'])
+
+# build the "left hand side" matrices for roller constraints. The
+# displacement constraint for each roller node is imposed in the row
+# for the x equation if the normal vector is mostly horizontal and in
+# the row for the y equation otherwise. The traction constraint is
+# imposed in the remaining row. This keeps the roller rows of `G_xx`
+# and `G_yy` from being zero, which would make the incomplete LU
+# decompositions used for the preconditioner fail. It is a heuristic
+# and does not guarantee that `G_xx` and `G_yy` are nonsingular
+roller = idx['boundary:roller']
+normals_x = normals[roller][:, 0]
+normals_y = normals[roller][:, 1]
+parallels = find_orthogonals(normals[roller])
+parallels_x = parallels[:, 0]
+parallels_y = parallels[:, 1]
+is_horizontal = np.abs(normals_x) >= np.abs(normals_y)
+for rows, disp_blocks, trac_blocks in [
+    (is_horizontal, (G_xx, G_xy), (G_yx, G_yy)),
+    (~is_horizontal, (G_yx, G_yy), (G_xx, G_xy))]:
+  # constrain displacements in the surface normal direction
+  out = outs[4]
+  stash_rows(disp_blocks[0], out['xx'][rows], roller[rows], 
+             scale=normals_x[rows])
+  stash_rows(disp_blocks[1], out['yy'][rows], roller[rows], 
+             scale=normals_y[rows])
+  # have zero traction parallel to the boundary. The stashed entries
+  # are summed when assembled, so there is no need to add the scaled
+  # matrices together here
+  out = outs[5]
+  stash_rows(trac_blocks[0], out['xx'][rows], roller[rows], 
+             scale=parallels_x[rows])
+  stash_rows(trac_blocks[0], out['yx'][rows], roller[rows], 
+             scale=parallels_y[rows])
+  stash_rows(trac_blocks[1], out['xy'][rows], roller[rows], 
+             scale=parallels_x[rows])
+  stash_rows(trac_blocks[1], out['yy'][rows], roller[rows], 
+             scale=parallels_y[rows])
+
+G_xx = assemble(G_xx, (N, N))
+G_xy = assemble(G_xy, (N, N))
+G_yx = assemble(G_yx, (N, N))
+G_yy = assemble(G_yy, (N, N))
+G = sp.bmat([[G_xx, G_xy], [G_yx, G_yy]], format='coo')
+
+# `min_energy_nodes` already sorted the nodes so that nearby nodes are
+# close together in memory. Reorder the unknowns so that the x and y
+# displacements for each node are also adjacent. This reduces the
+# bandwidth of `G` and the fill-in of its (incomplete) LU
+# decomposition
+perm = np.arange(2*N).reshape((2, N)).T.ravel()
+iperm = np.argsort(perm)
+G = sp.coo_matrix((G.data, (iperm[G.row], iperm[G.col])), shape=G.shape)
+# convert `G` to CSR format once, which is the efficient format for the
+# matrix-vector products in GMRES, and then sum the duplicate entries
+# and sort the indices once rather than implicitly in later operations
+G = G.tocsr()
+G.sum_duplicates()
+G.sort_indices()
+
+# form the right-hand-side vector, which is already in the interleaved
+# order. The only nonzero entries are from the y component of the body
+# force constraints, which are imposed at the interior nodes and the
+# ghost nodes
+idx_body = np.hstack((idx['interior'],
+                      idx['ghosts:free'],
+                      idx['ghosts:roller']))
+d = np.zeros((2*N,))
+d[2*idx_body + 1] = 1.0
+
+# solve the system using GMRES. The preconditioner is block diagonal,
+# where the blocks are incomplete LU decompositions of `G_xx` and
+# `G_yy`. The preconditioner only needs to approximate the inverse of
+# `G`, so the decompositions are computed and applied in single
+# precision, while GMRES computes the residuals in double precision.
+# Fall back to an LU decomposition if the incomplete LU decompositions
+# fail or if GMRES does not converge
+u = None
+try:
+  ilu_xx = spilu(G_xx.astype(np.float32).tocsc(), drop_tol=ilu_drop_tol, 
+                 fill_factor=10, permc_spec='MMD_ATA')
+  ilu_yy = spilu(G_yy.astype(np.float32).tocsc(), drop_tol=ilu_drop_tol, 
+                 fill_factor=10, permc_spec='MMD_ATA')
+
+except RuntimeError as err:
+  print('The incomplete LU decomposition failed (%s), solving with an '
+        'LU decomposition instead' % err)
+
+else:
+  def precondition(v):
+    # the x and y components of `v` are interleaved
+    v = v.astype(np.float32)
+    out = np.empty(v.shape, dtype=np.float64)
+    out[0::2] = ilu_xx.solve(v[0::2])
+    out[1::2] = ilu_yy.solve(v[1::2])
+    return out
+
+  M = LinearOperator(G.shape, precondition, dtype=np.float64)
+  u, info = gmres(G, d, M=M, restart=30, atol=1e-8, maxiter=200)
+  if info != 0:
+    print('GMRES did not converge (info=%s), solving with an LU '
+          'decomposition instead' % info)
+    u = None
+
+if u is None:
+  u = spsolve(G, d, permc_spec='MMD_ATA')
+
+# undo the interleaving of the x and y displacements
+u = np.reshape(u, (N, 2)).T
 u_x,u_y = u
 
 # Calculate strain and stress from displacements
-D_x = weight_matrix(nodes,nodes,(1,0),n=n)
-D_y = weight_matrix(nodes,nodes,(0,1),n=n)
+D_x, D_y = weight_matrices(nodes, nodes, [(1,0), (0,1)], 
+                           stencils=stencils)
 e_xx = D_x.dot(u_x)
 e_yy = D_y.dot(u_y)
 e_xy = 0.5*(D_y.dot(u_x) + D_x.dot(u_y))
@@ -161,12 +285,6 @@ s_xy = 2*mu*e_xy
 
 # plot the results
 #####################################################################
-def grid(x, y, z):
-    points = np.array([x,y]).T
-    xg,yg = np.mgrid[min(x):max(x):1000j,min(y):max(y):1000j]
-    zg = griddata(points,z,(xg,yg),method='linear')
-    return xg,yg,zg
-
 # toss out ghosts
 idx_no_ghosts = np.hstack((idx['interior'],
                            idx['boundary:roller'],
@@ -177,6 +295,15 @@ u_x, u_y = u_x[idx_no_ghosts], u_y[idx_no_ghosts]
 e_xx, e_yy, e_xy = e_xx[idx_no_ghosts], e_yy[idx_no_ghosts], e_xy[idx_no_ghosts]
 s_xx, s_yy, s_xy = s_xx[idx_no_ghosts], s_yy[idx_no_ghosts], s_xy[idx_no_ghosts]
 
+# interpolate the stresses onto a grid for the contour plots. The
+# triangulation of the nodes is computed once and all the stress
+# components are interpolated together
+tri = Delaunay(nodes)
+xg, yg = np.mgrid[nodes[:,0].min():nodes[:,0].max():500j,
+                  nodes[:,1].min():nodes[:,1].max():500j]
+interp = LinearNDInterpolator(tri, np.array([s_xx, s_yy, s_xy]).T)
+s_xxg, s_yyg, s_xyg = np.moveaxis(interp(xg, yg), -1, 0)
+
 fig, axs = plt.subplots(2, 2, figsize=(10, 7))
 poly = Polygon(vert, facecolor='none', edgecolor='k', zorder=3)
 axs[0][0].add_artist(poly)
@@ -186,8 +313,8 @@ poly = Polygon(vert, facecolor='none', edgecolor='k', zorder=3)
 axs[1][0].add_artist(poly)
 poly = Polygon(vert, facecolor='none', edgecolor='k', zorder=3)
 axs[1][1].add_artist(poly)
-# flip the bottom vertices to make a mask polygon
-vert[vert[:, -1] < 0.0] *= -1 
+# reflect the bottom vertices above the surface to make a mask polygon
+vert[:, 1] = np.abs(vert[:, 1])
 poly = Polygon(vert, facecolor='w', edgecolor='k', zorder=3)
 axs[0][0].add_artist(poly)
 poly = Polygon(vert, facecolor='w', edgecolor='k', zorder=3)
@@ -203,7 +330,6 @@ axs[0][0].set_ylim((-2, 1))
 axs[0][0].set_aspect('equal')
 axs[0][0].set_title('displacements', fontsize=10)
 
-xg, yg, s_xxg = grid(nodes[:,0], nodes[:,1], s_xx)
 p = axs[0][1].contourf(xg, yg, s_xxg, np.arange(-1.0, 0.04, 0.04), cmap='viridis', zorder=1)
 axs[0][1].set_xlim((0,3))
 axs[0][1].set_ylim((-2,1))
@@ -211,7 +337,6 @@ axs[0][1].set_aspect('equal')
 cbar = fig.colorbar(p,ax=axs[0][1])
 cbar.set_label('sigma_xx',fontsize=10)
 
-xg, yg, s_yyg = grid(nodes[:,0], nodes[:,1], s_yy)
 p = axs[1][0].contourf(xg, yg, s_yyg, np.arange(-2.6, 0.2, 0.2), cmap='viridis', zorder=1)
 axs[1][0].set_xlim((0, 3))
 axs[1][0].set_ylim((-2, 1))
@@ -219,7 +344,6 @@ axs[1][0].set_aspect('equal')
 cbar = fig.colorbar(p, ax=axs[1][0])
 cbar.set_label('sigma_yy', fontsize=10)
 
-xg, yg, s_xyg = grid(nodes[:,0], nodes[:,1], s_xy)
 p = axs[1][1].contourf(xg, yg, s_xyg, np.arange(0.0, 0.24, 0.02), cmap='viridis',zorder=1)
 axs[1][1].set_xlim((0, 3))
 axs[1][1].set_ylim((-2, 1))
@@ -248,13 +248,13 @@ class RBF(object):
     
     Parameters                                       
     ----------                                         
-    x : (N, D) float array 
+    x : (..., N, D) float array 
       Evaluation points
                                                                        
-    c : (M, D) float array 
+    c : (..., M, D) float array 
       RBF centers 
         
-    eps : float or (M,) float array, optional
+    eps : float or (..., M) float array, optional
       Shape parameters for each RBF. Defaults to 1.0
                                                                            
     diff : (D,) int array, optional
@@ -266,40 +266,48 @@ class RBF(object):
 
     Returns
     -------
-    (N, M) float array
+    (..., N, M) float array
       The RBFs with centers `c` evaluated at `x`
 
+    Notes
+    -----
+    `x`, `c`, and `eps` can have leading axes, which must be the same
+    for each of them. The RBFs are then evaluated independently for
+    each of the leading indices. This can be used to evaluate the RBFs
+    for many small sets of points without a python loop.
+
     '''
     x = np.asarray(x, dtype=float)
-    assert_shape(x, (None, None), 'x')
+    assert_shape(x, x.shape[:-2] + (None, None), 'x')
 
     c = np.asarray(c, dtype=float)
-    assert_shape(c, (None, x.shape[1]), 'c')
+    assert_shape(c, x.shape[:-2] + (None, x.shape[-1]), 'c')
 
     # makes `eps` an array of constant values if it is a scalar
     if np.isscalar(eps):
-      eps = np.full(c.shape[0], eps, dtype=float)
+      eps = np.full(c.shape[:-1], eps, dtype=float)
 
     else:  
       eps = np.asarray(eps, dtype=float)
-      assert_shape(eps, (c.shape[0],), 'eps')
+      assert_shape(eps, c.shape[:-1], 'eps')
 
     # if `diff` is not given then take no derivatives
     if diff is None:
-      diff = (0,)*x.shape[1]
+      diff = (0,)*x.shape[-1]
 
     else:
       # make sure diff is immutable
       diff = tuple(diff)
-      assert_shape(diff, (x.shape[1],), 'diff')
+      assert_shape(diff, (x.shape[-1],), 'diff')
 
     # add numerical function to cache if not already
     if diff not in self._cache:
       self._add_diff_to_cache(diff)
 
     # expand to allow for broadcasting
-    x = x.T[:, :, None] 
-    c = c.T[:, None, :]
+    x = np.moveaxis(x, -1, 0)[..., :, None] 
+    c = np.moveaxis(c, -1, 0)[..., None, :]
+    eps = eps[..., None, :]
     args = (tuple(x) + tuple(c) + (eps,))
     # evaluate the cached function for the given `x`, `c`, and `eps
     out = self._cache[diff](*args)
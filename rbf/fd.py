@@ -16,6 +16,11 @@ from rbf.linalg import PartitionedSolver
 
 logger = logging.getLogger(__name__)
 
+# the approximate number of bytes used by the dense systems when
+# `weight_matrices` computes the RBF-FD weights for a chunk of stencils
+# at once
+_STENCIL_CHUNK_BYTES = 2**26
+
 
 def _reshape_diffs(diffs):
   ''' 
@@ -64,6 +69,18 @@ def _max_poly_order(size, dim):
   return order
 
 
+def _stencil_chunk_size(size):
+  ''' 
+  Returns the number of stencils with `size` nodes whose RBF-FD
+  weights can be computed at once while staying within
+  `_STENCIL_CHUNK_BYTES`. The polynomial terms cannot outnumber the
+  stencil nodes, so each system has at most 2*`size` rows, and a few
+  arrays of that size are allocated for each stencil.
+  '''
+  stencil_bytes = 4*8*(2*size)**2
+  return max(_STENCIL_CHUNK_BYTES // stencil_bytes, 1)
+
+
 def weights(x, s, diffs, coeffs=None,
             basis=rbf.basis.phs3, order=None,
             eps=1.0):
@@ -161,17 +178,51 @@ def weights(x, s, diffs, coeffs=None,
   diffs = np.asarray(diffs, dtype=int)
   diffs = _reshape_diffs(diffs)
   
-  # stencil size and number of dimensions
-  size, dim = s.shape
   if coeffs is None:
     coeffs = np.ones(diffs.shape[0], dtype=float)
   else:
     coeffs = np.asarray(coeffs, dtype=float)
     assert_shape(coeffs, (diffs.shape[0],), 'coeffs')
 
+  w = _weights(x, s, [diffs], [coeffs], basis, order, eps)[:, 0]
+  return w
+
+
+def _weights(x, s, diffs, coeffs, basis, order, eps):
+  ''' 
+  Returns the RBF-FD weights for each of the differential operators
+  described by `diffs` and `coeffs`. The RBF-FD system is built and
+  factored once and then solved for each differential operator.
+
+  Parameters
+  ----------
+  x : (D,) float array
+
+  s : (N, D) float array
+
+  diffs : list of (K, D) int arrays
+
+  coeffs : list of (K,) float arrays
+
+  basis : rbf.basis.RBF
+
+  order : int or None
+    If None, this is the highest derivative order for all of the
+    differential operators
+
+  eps : float or (N,) array
+
+  Returns
+  -------
+  (N, Q) array
+    RBF-FD weights for each of the Q differential operators
+
+  '''
+  # stencil size and number of dimensions
+  size, dim = s.shape
   max_order = _max_poly_order(size, dim)
   if order is None:
-    order = _default_poly_order(diffs)
+    order = max(_default_poly_order(d) for d in diffs)
     order = min(order, max_order)
 
   if order > max_order:
@@ -184,18 +235,16 @@ def weights(x, s, diffs, coeffs=None,
   # becomes the left-hand-side
   A = basis(s, s, eps=eps)
   P = rbf.poly.mvmonos(s, powers)
-  # Evaluate the RBF and monomials for each term in the differential
-  # operator. This becomes the right-hand-side.
-  a = coeffs[0]*basis(x[None, :], s, eps=eps, diff=diffs[0])
-  p = coeffs[0]*rbf.poly.mvmonos(x[None, :], powers, diff=diffs[0])
-  for c, d in zip(coeffs[1:], diffs[1:]):
-    a += c*basis(x[None, :], s, eps=eps, diff=d)
-    p += c*rbf.poly.mvmonos(x[None, :], powers, diff=d)
-
-  # squeeze `a` and `p` into 1d arrays. `a` is ran through as_array
-  # because it may be sparse.
-  a = rbf.linalg.as_array(a)[0]
-  p = p[0]
+  # Evaluate the RBF and monomials for each term in each differential
+  # operator. These become the columns of the right-hand-side.
+  a = np.zeros((size, len(diffs)), dtype=float)
+  p = np.zeros((powers.shape[0], len(diffs)), dtype=float)
+  for i, (diffs_i, coeffs_i) in enumerate(zip(diffs, coeffs)):
+    for c, d in zip(coeffs_i, diffs_i):
+      # `as_array` is used because the RBF may be sparse
+      a[:, i] += c*rbf.linalg.as_array(
+        basis(x[None, :], s, eps=eps, diff=d))[0]
+      p[:, i] += c*rbf.poly.mvmonos(x[None, :], powers, diff=d)[0]
 
   # attempt to compute the RBF-FD weights
   try:
@@ -211,6 +260,78 @@ def weights(x, s, diffs, coeffs=None,
       (x, basis, order, s))
 
 
+def _stacked_weights(x, s, diffs, coeffs, basis, order, eps):
+  ''' 
+  Returns the RBF-FD weights for a stack of stencils. This is the same
+  as calling `_weights` for each stencil, except that the RBF-FD
+  systems are built and solved for all of the stencils at once.
+
+  Parameters
+  ----------
+  x : (B, D) float array
+
+  s : (B, N, D) float array
+
+  diffs : list of (K, D) int arrays
+
+  coeffs : list of (K, B) float arrays
+
+  basis : rbf.basis.RBF
+
+  order : int or None
+
+  eps : (B, N) array
+
+  Returns
+  -------
+  (B, N, Q) array
+    RBF-FD weights for each stencil and each of the Q differential
+    operators
+
+  '''
+  nstencils, size, dim = s.shape
+  max_order = _max_poly_order(size, dim)
+  if order is None:
+    order = max(_default_poly_order(d) for d in diffs)
+    order = min(order, max_order)
+
+  if order > max_order:
+    raise ValueError(
+      'Polynomial order is too high for the stencil size')
+    
+  powers = rbf.poly.powers(order, dim)
+  npoly = powers.shape[0]
+  # build the left-hand-side for each stencil
+  A = basis(s, s, eps=eps)
+  P = rbf.poly.mvmonos(s.reshape((-1, dim)), powers)
+  P = P.reshape((nstencils, size, npoly))
+  lhs = np.zeros((nstencils, size + npoly, size + npoly), dtype=float)
+  lhs[:, :size, :size] = A
+  lhs[:, :size, size:] = P
+  lhs[:, size:, :size] = P.transpose((0, 2, 1))
+  # build the right-hand-side for each stencil and differential
+  # operator
+  rhs = np.zeros((nstencils, size + npoly, len(diffs)), dtype=float)
+  for i, (diffs_i, coeffs_i) in enumerate(zip(diffs, coeffs)):
+    for c, d in zip(coeffs_i, diffs_i):
+      a = basis(x[:, None, :], s, eps=eps, diff=d)[:, 0, :]
+      rhs[:, :size, i] += c[:, None]*a
+      rhs[:, size:, i] += c[:, None]*rbf.poly.mvmonos(x, powers, diff=d)
+
+  try:
+    w = np.linalg.solve(lhs, rhs)[:, :size, :]
+    return w
+
+  except np.linalg.LinAlgError:
+    # find the stencil with the singular system and raise an
+    # informative error
+    for i in range(nstencils):
+      _weights(x[i], s[i], diffs, [c[:, i] for c in coeffs], 
+               basis, order, eps[i])
+
+    raise
+    
+
 def weight_matrix(x, p, diffs, coeffs=None,
                   basis=rbf.basis.phs3, order=None,
                   eps=1.0, n=None, stencils=None):
@@ -286,6 +407,72 @@ def weight_matrix(x, p, diffs, coeffs=None,
          [ 0.,  1., -2.,  1.],
          [ 0.,  1., -2.,  1.]])
                          
+  '''
+  out = weight_matrices(x, p, [diffs], coeffs=[coeffs], basis=basis,
+                        order=order, eps=eps, n=n, 
+                        stencils=stencils)[0]
+  return out
+
+
+def weight_matrices(x, p, diffs, coeffs=None,
+                    basis=rbf.basis.phs3, order=None,
+                    eps=1.0, n=None, stencils=None):
+  ''' 
+  Returns a weight matrix for each differential operator in `diffs`.
+  This produces the same output as calling `weight_matrix` for each
+  differential operator, except that the stencils are only found once
+  and the RBF-FD system for each stencil is only built and factored
+  once. This function should be used when multiple differential
+  operators are needed for the same target and source points.
+
+  Parameters
+  ----------
+  x : (N, D) array
+    Target points. 
+
+  p : (M, D) array
+    Source points. The stencils will be made up of these points.
+
+  diffs : list of (D,) int arrays or (K, D) int arrays
+    Derivative orders for each differential operator. See
+    `weight_matrix` for a description of the derivative orders for a
+    single differential operator.
+
+  coeffs : list of (K,) float arrays or (K, N) float arrays, optional 
+    Coefficients for the terms in each differential operator. An
+    element of this list can be None, in which case the coefficients
+    for that differential operator default to ones.
+
+  basis : rbf.basis.RBF, optional
+    Type of RBF. 
+
+  order : int, optional
+    Order of the added polynomial. This defaults to the highest
+    derivative order among all of the differential operators.
+
+  eps : float or (M,) array, optional
+    shape parameter for each RBF, which have centers `p`. 
+
+  n : int, optional
+    Stencil size. This defaults to the largest default stencil size
+    among all of the differential operators.
+    
+  stencils : (N, n) int array, optional
+    The stencils for each node in `x`. If this is given then the value
+    for `n` will be ignored. 
+
+  Returns
+  -------
+  list of (N, M) csc sparse matrices
+      
+  Examples
+  --------
+  Create the x and y differentiation matrices in two-dimensional
+  space
+
+  >>> x = np.random.random((10, 2))
+  >>> D_x, D_y = weight_matrices(x, x, [(1, 0), (0, 1)], n=5)
+                         
   '''
   x = np.asarray(x, dtype=float)
   assert_shape(x, (None, None), 'x')
@@ -293,8 +480,7 @@ def weight_matrix(x, p, diffs, coeffs=None,
   p = np.asarray(p, dtype=float)
   assert_shape(p, (None, x.shape[1]), 'p')
   
-  diffs = np.asarray(diffs, dtype=int)
-  diffs = _reshape_diffs(diffs)
+  diffs = [_reshape_diffs(np.asarray(d, dtype=int)) for d in diffs]
 
   if np.isscalar(eps):
     eps = np.full(p.shape[0], eps, dtype=float)
@@ -302,22 +488,30 @@ def weight_matrix(x, p, diffs, coeffs=None,
     eps = np.asarray(eps, dtype=float)  
     assert_shape(eps, (p.shape[0],), 'eps')
     
-  
-  # make `coeffs` a (K, N) array
+  # make each element of `coeffs` a (K, N) array
   if coeffs is None:
-    coeffs = np.ones((diffs.shape[0], x.shape[0]), dtype=float)
-  else:
-    coeffs = np.asarray(coeffs, dtype=float)
-    if coeffs.ndim == 1:
-      coeffs = np.repeat(coeffs[:, None], x.shape[0], axis=1) 
+    coeffs = [None for d in diffs]
 
-    assert_shape(coeffs, (diffs.shape[0], x.shape[0]), 'coeffs')      
+  if len(coeffs) != len(diffs):
+    raise ValueError(
+      '`coeffs` should have the same length as `diffs`')
+
+  coeffs = list(coeffs)
+  for i, d in enumerate(diffs):
+    if coeffs[i] is None:
+      coeffs[i] = np.ones((d.shape[0], x.shape[0]), dtype=float)
+    else:
+      coeffs[i] = np.asarray(coeffs[i], dtype=float)
+      if coeffs[i].ndim == 1:
+        coeffs[i] = np.repeat(coeffs[i][:, None], x.shape[0], axis=1) 
+
+      assert_shape(coeffs[i], (d.shape[0], x.shape[0]), 'coeffs')      
    
   if stencils is None:
     if n is None:
       # if stencil size is not given then use the default stencil
       # size. Make sure that this is no larger than `p`
-      n = _default_stencil_size(diffs)
+      n = max(_default_stencil_size(d) for d in diffs)
       n = min(n, p.shape[0])
 
     stencils = rbf.stencil.stencil_network(x, p, n)
@@ -326,28 +520,41 @@ def weight_matrix(x, p, diffs, coeffs=None,
     assert_shape(stencils, (x.shape[0], None), 'stencils')
   
   logger.debug(
-    'building a (%s, %s) RBF-FD weight matrix with %s nonzeros...' 
-    % (x.shape[0], p.shape[0], stencils.size))   
-
-  # values that will be put into the sparse matrix
-  data = np.zeros(stencils.shape, dtype=float)
-  for i, si in enumerate(stencils):
-    # intermittently log the progress 
-    if i % max(stencils.shape[0] // 10, 1) == 0:
-      logger.debug('  %d%% complete' % (100*i / stencils.shape[0]))
-
-    data[i, :] = weights(x[i], p[si], diffs,
-                         coeffs=coeffs[:, i], eps=eps[si],
-                         basis=basis, order=order)
+    'building %s (%s, %s) RBF-FD weight matrices with %s nonzeros...' 
+    % (len(diffs), x.shape[0], p.shape[0], stencils.size))   
+
+  # values that will be put into the sparse matrices
+  data = np.zeros((len(diffs),) + stencils.shape, dtype=float)
+  if isinstance(basis, rbf.basis.SparseRBF):
+    # `SparseRBF` instances cannot be evaluated for multiple stencils
+    # at once, so compute the weights one stencil at a time
+    for i, si in enumerate(stencils):
+      # intermittently log the progress 
+      if i % max(stencils.shape[0] // 10, 1) == 0:
+        logger.debug('  %d%% complete' % (100*i / stencils.shape[0]))
+
+      data[:, i, :] = _weights(x[i], p[si], diffs, 
+                               [c[:, i] for c in coeffs], 
+                               basis, order, eps[si]).T
 
-    
-  rows = np.repeat(range(data.shape[0]), data.shape[1])
+  else:
+    # compute the weights for chunks of stencils at once
+    chunk_size = _stencil_chunk_size(stencils.shape[1])
+    for start in range(0, stencils.shape[0], chunk_size):
+      logger.debug('  %d%% complete' % (100*start / stencils.shape[0]))
+      stop = start + chunk_size
+      si = stencils[start:stop]
+      data[:, start:stop, :] = _stacked_weights(
+        x[start:stop], p[si], diffs, 
+        [c[:, start:stop] for c in coeffs], 
+        basis, order, eps[si]).transpose((2, 0, 1))
+
+  rows = np.repeat(range(stencils.shape[0]), stencils.shape[1])
   cols = stencils.ravel()
-  data = data.ravel()
   shape = x.shape[0], p.shape[0]
-  L = sp.csc_matrix((data, (rows, cols)), shape)
+  out = [sp.csc_matrix((d.ravel(), (rows, cols)), shape) for d in data]
   logger.debug('  done')
-  return L
+  return out
                 
 
 def add_rows(A, B, idx):
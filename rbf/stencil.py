@@ -6,7 +6,7 @@ from __future__ import division
 import numpy as np
 from scipy.spatial import cKDTree
 from rbf.geometry import intersection_count
-from rbf.utils import assert_shape
+from rbf.utils import assert_shape, Memoize
 import networkx
 
 class StencilError(Exception):
@@ -124,6 +124,35 @@ def _stencil(c, x, n, vert, smp):
     raise StencilError('cannot not form a stencil with size %s' % n)
 
 
+def _build_kdtree(p):
+  ''' 
+  Returns a KD-tree for the points `p`. The unbalanced tree with larger
+  leaves is faster to build and about as fast to query. The tree gets
+  its own copy of `p` so that a cached tree does not keep `p` alive.
+  '''
+  return cKDTree(p, leafsize=32, balanced_tree=False, 
+                 compact_nodes=False, copy_data=True)
+
+_cached_kdtree = Memoize(_build_kdtree, by_identity=True)
+
+
+def _kdtree(p):
+  ''' 
+  Returns a KD-tree for the points `p`. The trees are cached by the
+  identity of `p`, so repeatedly forming stencils from the same array
+  of points only builds one tree. Since `p` may have been modified in
+  place since its tree was cached, the cached tree is only used if its
+  data is still equal to `p`. Otherwise the stale tree is removed
+  from the cache and the tree is rebuilt.
+  '''
+  T = _cached_kdtree(p)
+  if not np.array_equal(T.data, p):
+    _cached_kdtree.forget(p)
+    T = _cached_kdtree(p)
+
+  return T
+
+
 def _stencil_network_no_boundary(x, p, n):
   ''' 
   Returns the `n` nearest points in `p` for each point in `x`
@@ -131,7 +160,7 @@ def _stencil_network_no_boundary(x, p, n):
   if n == 0:
     out = np.zeros((x.shape[0], 0), dtype=int)
   else:
-    T = cKDTree(p)
+    T = _kdtree(p)
     dummy, out = T.query(x, n)
     if n == 1:
       out = out[:, None]
@@ -167,6 +196,15 @@ def stencil_network(x, p, n, vert=None, smp=None):
   sn : (N, D) array
     Indices of points in `p` which form a stencil for each point in 
     `x`.
+
+  Notes
+  -----
+  The KD-tree used to find the nearest points in `p` is cached and
+  reused when this function is called again with the same `p` array,
+  as long as the contents of `p` have not changed. Each cached tree
+  holds its own copy of `p` until `p` is garbage collected, and up to
+  128 trees are cached. The cached trees can be released with
+  `rbf.utils.clear_memoize_caches`.
     
   '''
   x = np.asarray(x, dtype=float)
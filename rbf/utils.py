@@ -1,10 +1,24 @@
 import sys
 import inspect
 import weakref
-from collections import OrderedDict
+import logging
+from collections import deque
 
 import numpy as np
 
+LOGGER = logging.getLogger(__name__)
+
+try:
+  import xxhash
+  HAS_XXHASH = True
+
+except ImportError:
+  HAS_XXHASH = False
+  LOGGER.debug(
+    'Could not import xxhash. Memoized functions will copy the '
+    'contents of array arguments to use as cache keys. To install '
+    'xxhash, use the command `pip install xxhash`')
+
 
 def assert_shape(arr, shape, label):
   ''' 
@@ -15,6 +29,10 @@ def assert_shape(arr, shape, label):
     arr_shape = arr.shape
   else:
     arr_shape = np.shape(arr)
+
+  # fast path for when every axis length is specified and correct
+  if arr_shape == shape:
+    return
     
   if len(arr_shape) != len(shape):
     raise ValueError(
@@ -33,11 +51,31 @@ def assert_shape(arr, shape, label):
   return
 
 
+def _array_digest(arr):
+  '''
+  Returns a 128 bit xxhash digest of the contents of `arr`. The buffer
+  of a C-contiguous array is hashed directly, so no copy of the data
+  is made.
+  '''
+  buf = np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+  return xxhash.xxh3_128_digest(buf)
+
+
 def get_arg_count(func):
   ''' 
   Returns the number of arguments that can be specified positionally
   for a function. If this cannot be inferred then -1 is returned.
   '''
+  if inspect.isfunction(func):
+    # for plain python functions, the argument count can be read
+    # directly from the code object, which is much faster than
+    # building a signature
+    code = func.__code__
+    if code.co_flags & inspect.CO_VARARGS:
+      return -1
+
+    return code.co_argcount  
+
   # get the python version. If < 3.3 then use inspect.getargspec,
   # otherwise use inspect.signature
   if sys.version_info < (3, 3):
@@ -68,8 +106,21 @@ def get_arg_count(func):
 class Memoize(object):
   '''
   An memoizing decorator. The max cache size is hard-coded at 128.
-  When the limit is reached, the least recently used (LRU) item is
-  dropped.
+  When the limit is reached, the oldest item in the cache is dropped
+  (i.e., the cache is first in first out).
+
+  Parameters
+  ----------
+  fin : function
+
+  by_identity : bool, optional
+    If True, then the arguments are identified by their `id`, shape,
+    and strides rather than their value. This avoids hashing large
+    array arguments, but it should only be used when the arguments are
+    not modified in place. The arguments must support weak
+    references, and the cached output for an argument is dropped when
+    the argument is garbage collected.
+
   '''
   # variable controlling the maximum cache size for all memoized
   # functions
@@ -77,10 +128,15 @@ class Memoize(object):
   # collection of weak references to all instances
   _INSTANCES = []
 
-  def __init__(self, fin):
+  def __init__(self, fin, by_identity=False):
     self.fin = fin
-    # the cache will be ordered from least to most recently used
-    self.cache = OrderedDict()
+    self.by_identity = by_identity
+    self.cache = {}
+    # the cache keys ordered from oldest to newest
+    self.order = deque()
+    # weak references to the arguments for each key when
+    # `by_identity` is True
+    self.refs = {}
     Memoize._INSTANCES += [weakref.ref(self)]    
     
   @staticmethod    
@@ -88,32 +144,69 @@ class Memoize(object):
     # convert the arguments to a hashable object. In this case, the
     # argument tuple is assumed to already be hashable
     return args
+
+  @staticmethod
+  def _as_identity_key(args):
+    # identify the arguments by their memory address, which only takes
+    # a constant amount of time regardless of the argument size
+    key = tuple((id(a), np.shape(a), getattr(a, 'strides', None)) 
+                for a in args)
+    return key
+
+  def _discard(self, key):
+    # removes `key` from the cache if it has not already been removed
+    if key in self.cache:
+      del self.cache[key]
+      self.refs.pop(key, None)
+      self.order.remove(key)
     
   def __call__(self, *args):        
-    key = self._as_key(args)
+    if self.by_identity:
+      key = self._as_identity_key(args)
+    else:  
+      key = self._as_key(args)
+
     try:
+      # cache hits do not change the order of the cache, so this is
+      # the only dictionary lookup
       value = self.cache[key]
-      # move the item to the end signifying that it was most recently
-      # used
-      try:
-        # move_to_end is an attribute of OrderedDict in python 3. try
-        # calling it and if the attribute does not exist then fall
-        # back to the slow method
-        self.cache.move_to_end(key)
-
-      except AttributeError:
-        self.cache[key] = self.cache.pop(key)  
-        
-                
+      # make sure that the cached arguments are the same objects as
+      # `args` and not objects that have since reused their ids
+      if (not self.by_identity or 
+          all(r() is a for r, a in zip(self.refs[key], args))):
+        return value
+
+      self._discard(key)
+
     except KeyError:
-      if len(self.cache) == Memoize._MAXSIZE:
-        # remove the first item which is the least recently used item
-        self.cache.popitem(0)
+      pass
+      
+    if self.by_identity:
+      # drop the cached value once any of the arguments is garbage
+      # collected. Make the weak references before evaluating the
+      # function so that invalid arguments do not evict anything from
+      # the cache
+      callback = lambda r, key=key: self._discard(key)
+      refs = []
+      for a in args:
+        try:
+          refs += [weakref.ref(a, callback)]
+        except TypeError:
+          raise ValueError(
+            'Memoized functions with `by_identity=True` require '
+            'arguments that support weak references, but an argument '
+            'has type %s' % type(a).__name__)
+
+    value = self.fin(*args)
+    if len(self.cache) == Memoize._MAXSIZE:
+      # remove the oldest item from the cache
+      self._discard(self.order[0])
             
-      value = self.fin(*args)
-      # add the function output to the end of the cache
-      self.cache[key] = value
+    if self.by_identity:
+      self.refs[key] = tuple(refs)
 
+    self.order.append(key)
+    self.cache[key] = value
     return value
              
   def __repr__(self):
@@ -121,19 +214,39 @@ class Memoize(object):
 
   def clear_cache(self):
     '''Clear the cached function output'''
-    self.cache = OrderedDict()
+    self.cache = {}
+    self.order = deque()
+    self.refs = {}
+
+  def forget(self, *args):
+    '''Remove the cached function output for `args`, if there is any'''
+    if self.by_identity:
+      key = self._as_identity_key(args)
+    else:  
+      key = self._as_key(args)
+
+    self._discard(key)
     
 
 class MemoizeArrayInput(Memoize):
     '''
     A memoizing decorator for functions that take only numpy arrays as
     input. The max cache size is hard-coded at 128. When the limit is
-    reached, the least recently used (LRU) item is dropped.
+    reached, the oldest item is dropped.
     '''
     @staticmethod
     def _as_key(args):
-        # create a key that is unique for the input arrays
-        key = tuple((a.tobytes(), a.shape, a.dtype) for a in args)
+        # create a key that is unique for the input arrays. If xxhash
+        # is available then the array contents are fingerprinted with
+        # a hash digest rather than being copied into a `bytes` object.
+        # Other hash functions are slower than copying the contents
+        if HAS_XXHASH:
+            key = tuple((_array_digest(a), a.shape, a.dtype.str) 
+                        for a in args)
+        else:
+            key = tuple((a.tobytes(), a.shape, a.dtype.str) 
+                        for a in args)
+
         return key
 
 
@@ -101,5 +101,17 @@ class Test(unittest.TestCase):
     check = np.all(np.isclose(out1,out2))
     self.assertTrue(check)
 
+  def test_stacked_input(self):
+    # evaluating a stack of point sets at once should be the same as
+    # evaluating each point set separately
+    np.random.seed(1)
+    x = np.random.random((4,5,2))
+    c = np.random.random((4,3,2))
+    eps = np.random.random((4,3))
+    out = rbf.basis.phs3(x,c,eps=eps,diff=(1,0))
+    for i in range(4):
+      out_i = rbf.basis.phs3(x[i],c[i],eps=eps[i],diff=(1,0))
+      self.assertTrue(np.allclose(out[i],out_i))
+
 
 #unittest.main()
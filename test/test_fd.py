@@ -179,3 +179,14 @@ class Test(unittest.TestCase):
     self.assertTrue(np.isclose(u.dot(w),diff_true,atol=1e-2))
     
                          
+
+  def test_weight_matrices(self):
+    # make sure that `weight_matrices` gives the same result as calling
+    # `weight_matrix` for each differential operator
+    x = rbf.halton.halton(50,2)
+    diffs = [(1,0),[(2,0),(0,2)]]
+    coeffs = [None,[2.0,3.0]]
+    out = rbf.fd.weight_matrices(x,x,diffs,coeffs=coeffs,n=10)
+    for d,c,W in zip(diffs,coeffs,out):
+      W_true = rbf.fd.weight_matrix(x,x,d,coeffs=c,n=10,order=2)
+      self.assertTrue(np.allclose(W.toarray(),W_true.toarray()))
@@ -54,3 +54,30 @@ class Test(unittest.TestCase):
     self.assertTrue(np.all(n==nest))
 
 
+
+  def test_kdtree_cache(self):
+    # the KD-tree for the source points should be reused when forming
+    # stencils with the same array of source points
+    pop = np.random.random((100, 2))
+    query = np.random.random((10, 2))
+    rbf.stencil._cached_kdtree.clear_cache()
+    sn1 = rbf.stencil.stencil_network(query, pop, 5)
+    sn2 = rbf.stencil.stencil_network(query[:5], pop, 5)
+    self.assertTrue(len(rbf.stencil._cached_kdtree.cache) == 1)
+    self.assertTrue(np.all(sn1[:5] == sn2))
+    # modifying the source points in place should not give stencils
+    # from the old source points
+    other = np.random.random((50, 2))
+    rbf.stencil.stencil_network(query, other, 5)
+    pop[:] = pop[::-1]
+    sn3 = rbf.stencil.stencil_network(query, pop, 5)
+    self.assertTrue(np.all(sn3 == pop.shape[0] - 1 - sn1))
+    # only the stale tree should have been rebuilt, and the tree for
+    # the unrelated source points should still be cached
+    key = rbf.stencil._cached_kdtree._as_identity_key((other,))
+    self.assertTrue(key in rbf.stencil._cached_kdtree.cache)
+    self.assertTrue(len(rbf.stencil._cached_kdtree.cache) == 2)
+    # the cached tree should be dropped once the source points are
+    # garbage collected
+    del pop
+    self.assertTrue(len(rbf.stencil._cached_kdtree.cache) == 1)
@@ -63,6 +63,14 @@ class Test(unittest.TestCase):
     count = rbf.utils.get_arg_count(func4)
     self.assertTrue(count == -1)
 
+    # bound methods should not count `self`
+    class Class(object):
+      def method(self,a,b):
+        return
+
+    count = rbf.utils.get_arg_count(Class().method)
+    self.assertTrue(count == 2)
+
   def test_memoize_array_input(self):
     def func(a):
       return a
@@ -79,11 +87,65 @@ class Test(unittest.TestCase):
       memfunc(np.array([i]))
     
     self.assertTrue(len(memfunc.cache) == 128)
+    # the cache is first in first out, so only the 128 most recent
+    # inputs should be cached
+    self.assertTrue(len(memfunc.order) == 128)
+    self.assertTrue(memfunc.order[0] == memfunc._as_key((np.array([72]),)))
 
     # clear the cache and make sure the cache size goes back to zero
     rbf.utils.clear_memoize_caches()
     self.assertTrue(len(memfunc.cache) == 0)
+
+  def test_memoize_array_input_keys(self):
+    def func(a):
+      return a
+    
+    memfunc = rbf.utils.MemoizeArrayInput(func)  
+    # arrays with the same contents should share a cache entry, even
+    # if they are not contiguous
+    arr = np.arange(10.0)
+    memfunc(arr[::2])
+    memfunc(np.array(arr[::2]))
+    self.assertTrue(len(memfunc.cache) == 1)
+
+    # arrays with the same bytes but different dtypes or shapes should
+    # have separate cache entries
+    memfunc(arr[::2].view(np.int64))
+    memfunc(np.array(arr[::2])[:, None])
+    self.assertTrue(len(memfunc.cache) == 3)
       
 
     
     
+
+  def test_memoize_by_identity(self):
+    calls = []
+    def func(a):
+      calls.append(None)
+      return a.sum()
+    
+    memfunc = rbf.utils.Memoize(func, by_identity=True)  
+    # the same array object should hit the cache, while a copy of it
+    # should not
+    arr = np.arange(10.0)
+    memfunc(arr)
+    memfunc(arr)
+    self.assertTrue(len(calls) == 1)
+    memfunc(np.array(arr))
+    self.assertTrue(len(calls) == 2)
+
+    # the cache entry should be dropped once the array is garbage
+    # collected
+    self.assertTrue(len(memfunc.cache) == 1)
+    del arr
+    self.assertTrue(len(memfunc.cache) == 0)
+    self.assertTrue(len(memfunc.order) == 0)
+
+    # arguments that do not support weak references should raise an
+    # error without evaluating the function or evicting cached values
+    arr = np.arange(10.0)
+    memfunc(arr)
+    ncalls = len(calls)
+    self.assertRaises(ValueError, memfunc, 1.0)
+    self.assertTrue(len(calls) == ncalls)
+    self.assertTrue(len(memfunc.cache) == 1)